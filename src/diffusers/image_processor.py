@@ -12,7 +12,9 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import os
 import warnings
+from concurrent.futures import ThreadPoolExecutor
 from typing import List, Optional, Union
 
 import numpy as np
@@ -21,9 +23,18 @@ import torch
 from PIL import Image
 
 from .configuration_utils import ConfigMixin, register_to_config
-from .utils import CONFIG_NAME, PIL_INTERPOLATION, deprecate
+from .utils import BACKENDS_MAPPING, CONFIG_NAME, PIL_INTERPOLATION, deprecate, is_opencv_available, logging
 
 
+logger = logging.get_logger(__name__)  # pylint: disable=invalid-name
+
+# Pillow-SIMD is a drop-in replacement for Pillow with SSE4/AVX2 resampling kernels, released with a `.postN` suffix.
+if ".post" not in PIL.__version__:
+    logger.info(
+        f"Using Pillow {PIL.__version__}. Resizing PIL images can be considerably faster with Pillow-SIMD, which can"
+        ' be installed with `pip uninstall pillow && CC="cc -mavx2" pip install -U --force-reinstall pillow-simd`.'
+    )
+
 PipelineImageInput = Union[
     PIL.Image.Image,
     np.ndarray,
@@ -33,6 +44,136 @@ PipelineImageInput = Union[
     List[torch.FloatTensor],
 ]
 
+_SUPPORTED_FORMATS = (PIL.Image.Image, np.ndarray, torch.Tensor)
+
+
+# PIL and OpenCV release the GIL while converting and resampling, so the images of a batch can be processed concurrently
+# on a shared thread pool. It is created lazily, and again in forked children (e.g. DataLoader workers), since the
+# worker threads of the parent don't exist there.
+_IMAGE_POOL = None
+
+
+def _get_image_pool() -> ThreadPoolExecutor:
+    global _IMAGE_POOL
+    if _IMAGE_POOL is None:
+        _IMAGE_POOL = ThreadPoolExecutor(max_workers=min(os.cpu_count() or 1, 8))
+    return _IMAGE_POOL
+
+
+def _reset_image_pool():
+    global _IMAGE_POOL
+    _IMAGE_POOL = None
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_image_pool)
+
+
+def _map_images(fn, images: List[Union[PIL.Image.Image, np.ndarray]]) -> List[Union[PIL.Image.Image, np.ndarray]]:
+    """
+    Apply `fn` to every image of a list, on the shared thread pool when there is more than one image.
+    """
+    if len(images) > 1:
+        return list(_get_image_pool().map(fn, images))
+    return [fn(image) for image in images]
+
+
+# OpenCV interpolation flags matching each resampling filter, looked up on `cv2` once it is imported
+CV2_INTERPOLATION = {
+    "linear": "INTER_LINEAR",
+    "bilinear": "INTER_LINEAR",
+    "bicubic": "INTER_CUBIC",
+    "lanczos": "INTER_LANCZOS4",
+    "nearest": "INTER_NEAREST",
+}
+
+
+# lookup tables mapping uint8 pixel values to [0,1] and to [-1,1] respectively
+_UNIT_LUT = np.arange(256, dtype=np.float32) / np.float32(255.0)
+_NORM_LUT = np.arange(256, dtype=np.float32) / np.float32(127.5) - np.float32(1.0)
+
+
+def _pil_to_float32(
+    images: List[PIL.Image.Image], normalize: bool = False, out: Optional[np.ndarray] = None
+) -> np.ndarray:
+    """
+    Convert a list of PIL images to a single float32 array in [0,1], or in [-1,1] if `normalize` is `True`. The array
+    is written into `out` if it is a C-contiguous float32 array of the same shape, with a trailing channel dimension of
+    size 1 allowed for single-channel images.
+    """
+    lut = _NORM_LUT if normalize else _UNIT_LUT
+    # fill a single preallocated buffer rather than stacking a list of per-image float copies
+    arrays = [np.asarray(image) for image in images]
+    shape = (len(arrays),) + arrays[0].shape
+    # `out` is only written to once the whole batch is known to fit it, so a mismatch never leaves it half-overwritten
+    if (
+        out is not None
+        and out.dtype == np.float32
+        and out.flags.c_contiguous
+        and out.shape in (shape, shape + (1,))
+        and all(array.shape == arrays[0].shape for array in arrays)
+    ):
+        out = out.reshape(shape)
+    else:
+        out = np.empty(shape, dtype=np.float32)
+    for i, array in enumerate(arrays):
+        if array.dtype == np.uint8:
+            # a single gather through the lookup table converts, rescales and normalizes in one pass
+            np.take(lut, array, out=out[i], mode="clip")
+        else:
+            out[i] = array
+            out[i] *= np.float32(1.0 / 255.0)
+            if normalize:
+                out[i] = 2.0 * out[i] - 1.0
+
+    return out
+
+
+def _pil_to_uint8(images: List[PIL.Image.Image], pin_memory: bool = False) -> Optional[torch.Tensor]:
+    """
+    Convert a list of 8-bit PIL images to a single channels-last uint8 tensor, or return `None` if any image has another
+    pixel type. With `pin_memory`, the tensor is allocated in page-locked memory so it can be copied to a GPU
+    asynchronously.
+    """
+    arrays = [np.asarray(image) for image in images]
+    if any(array.dtype != np.uint8 for array in arrays):
+        return None
+    # allocated through torch rather than NumPy, so that the pinned buffer stays tracked by its caching host allocator
+    # until the asynchronous copy has completed
+    out = torch.empty((len(arrays),) + arrays[0].shape, dtype=torch.uint8, pin_memory=pin_memory)
+    out_np = out.numpy()
+    for i, array in enumerate(arrays):
+        out_np[i] = array
+
+    if out.ndim == 3:
+        out = out.unsqueeze(-1)
+    return out.permute(0, 3, 1, 2)
+
+
+def _uint8_to_float32(images: torch.Tensor, normalize: bool = False) -> torch.Tensor:
+    """
+    Convert a uint8 PyTorch tensor to float32 in [0,1], or in [-1,1] if `normalize` is `True`, on its own device. The
+    result matches the lookup tables used by `_pil_to_float32`.
+    """
+    images = images.float()
+    return images.div_(127.5).sub_(1.0) if normalize else images.div_(255.0)
+
+
+def _pt_to_uint8_numpy(images: torch.FloatTensor, do_denormalize: Optional[List[bool]] = None) -> np.ndarray:
+    """
+    Quantize a PyTorch tensor in [0,1] to a uint8 NumPy image on its own device, so only uint8 data is copied to host.
+    The images for which `do_denormalize` is `True` are first denormalized from [-1,1], in the same buffer.
+    """
+    images = images.to(torch.float32, copy=True)
+    if do_denormalize is not None and all(do_denormalize):
+        images.mul_(0.5).add_(0.5)
+    elif do_denormalize is not None and any(do_denormalize):
+        mask = torch.tensor(do_denormalize, device=images.device).view(-1, 1, 1, 1)
+        images = torch.where(mask, images * 0.5 + 0.5, images)
+    images = images.clamp_(0, 1).mul_(255).round_().to(torch.uint8)
+    images = images.permute(0, 2, 3, 1).contiguous().cpu().numpy()
+    return images
+
 
 class VaeImageProcessor(ConfigMixin):
     """
@@ -54,6 +195,9 @@ class VaeImageProcessor(ConfigMixin):
             Whether to convert the images to RGB format.
         do_convert_grayscale (`bool`, *optional*, defaults to be `False`):
             Whether to convert the images to grayscale format.
+        use_opencv_resize (`bool`, *optional*, defaults to `False`):
+            Whether to resize float NumPy images with OpenCV and the `resample` filter, instead of nearest-neighbour
+            interpolation. Requires `opencv-python`.
     """
 
     config_name = CONFIG_NAME
@@ -68,6 +212,7 @@ class VaeImageProcessor(ConfigMixin):
         do_binarize: bool = False,
         do_convert_rgb: bool = False,
         do_convert_grayscale: bool = False,
+        use_opencv_resize: bool = False,
     ):
         super().__init__()
         if do_convert_rgb and do_convert_grayscale:
@@ -78,14 +223,32 @@ class VaeImageProcessor(ConfigMixin):
             )
             self.config.do_convert_rgb = False
 
+        # resolved once here rather than through the config on every resize
+        self._resample = PIL_INTERPOLATION[resample]
+        self._cv2_resize = None
+        self._cv2_interpolation = None
+        if use_opencv_resize:
+            # imported lazily, so that importing diffusers never depends on OpenCV
+            if is_opencv_available():
+                import cv2
+            else:
+                raise ImportError(BACKENDS_MAPPING["opencv"][1].format("`use_opencv_resize=True`"))
+            self._cv2_resize = cv2.resize
+            self._cv2_interpolation = getattr(cv2, CV2_INTERPOLATION[resample])
+        self._vae_scale_factor = vae_scale_factor
+
     @staticmethod
     def numpy_to_pil(images: np.ndarray) -> PIL.Image.Image:
         """
-        Convert a numpy image or a batch of images to a PIL image.
+        Convert a numpy image or a batch of images to a PIL image. Float images are expected in [0,1], uint8 images are
+        used as is.
         """
         if images.ndim == 3:
             images = images[None, ...]
-        images = (images * 255).round().astype("uint8")
+        if images.dtype != np.uint8:
+            images = (images * 255).round().astype("uint8")
+        # PIL copies non-contiguous arrays image by image, so make the whole batch contiguous at once instead
+        images = np.ascontiguousarray(images)
         if images.shape[-1] == 1:
             # special case for grayscale (single channel) images
             pil_images = [Image.fromarray(image.squeeze(), mode="L") for image in images]
@@ -101,20 +264,28 @@ class VaeImageProcessor(ConfigMixin):
         """
         if not isinstance(images, list):
             images = [images]
-        images = [np.array(image).astype(np.float32) / 255.0 for image in images]
-        images = np.stack(images, axis=0)
-
-        return images
+        return _pil_to_float32(images)
 
     @staticmethod
-    def numpy_to_pt(images: np.ndarray) -> torch.FloatTensor:
+    def numpy_to_pt(images: np.ndarray, memory_format: torch.memory_format = torch.channels_last) -> torch.FloatTensor:
         """
         Convert a NumPy image to a PyTorch tensor.
+
+        Args:
+            images (`np.ndarray`):
+                The image or batch of images, with channels last.
+            memory_format (`torch.memory_format`, *optional*, defaults to `torch.channels_last`):
+                The memory format of the returned tensor. `torch.channels_last` matches the NHWC layout of the NumPy
+                input, so the tensor is a view of it that needs no reorder, and it can be consumed as is by models
+                converted with `model.to(memory_format=torch.channels_last)`. Any other format makes a copy.
         """
         if images.ndim == 3:
             images = images[..., None]
 
-        images = torch.from_numpy(images.transpose(0, 3, 1, 2))
+        # NHWC storage viewed as NCHW already has channels-last strides
+        images = torch.from_numpy(np.ascontiguousarray(images)).permute(0, 3, 1, 2)
+        if memory_format != torch.channels_last:
+            images = images.contiguous(memory_format=memory_format)
         return images
 
     @staticmethod
@@ -126,10 +297,13 @@ class VaeImageProcessor(ConfigMixin):
         return images
 
     @staticmethod
-    def normalize(images):
+    def normalize(images, inplace: bool = False):
         """
-        Normalize an image array to [-1,1].
+        Normalize an image array to [-1,1]. Floating point PyTorch tensors are normalized in place if `inplace` is
+        `True`.
         """
+        if inplace and isinstance(images, torch.Tensor) and images.is_floating_point():
+            return images.mul_(2.0).sub_(1.0)
         return 2.0 * images - 1.0
 
     @staticmethod
@@ -137,7 +311,20 @@ class VaeImageProcessor(ConfigMixin):
         """
         Denormalize an image array to [0,1].
         """
-        return (images / 2 + 0.5).clamp(0, 1)
+        return images.mul(0.5).add_(0.5).clamp_(0, 1)
+
+    def _denormalize_conditionally(self, images: torch.FloatTensor, do_denormalize: List[bool]) -> torch.FloatTensor:
+        """
+        Denormalize the images of a batch for which `do_denormalize` is `True`, using a single op on the whole batch.
+        """
+        if all(do_denormalize):
+            return self.denormalize(images)
+        if not any(do_denormalize):
+            # still return a new tensor, so that callers can modify the output without touching their input
+            return images.clone()
+
+        mask = torch.tensor(do_denormalize, device=images.device).view(-1, 1, 1, 1)
+        return torch.where(mask, self.denormalize(images), images)
 
     @staticmethod
     def convert_to_rgb(image: PIL.Image.Image) -> PIL.Image.Image:
@@ -195,7 +382,7 @@ class VaeImageProcessor(ConfigMixin):
                 width = image.shape[2]
 
         width, height = (
-            x - x % self.config.vae_scale_factor for x in (width, height)
+            x - x % self._vae_scale_factor for x in (width, height)
         )  # resize to integer multiple of vae_scale_factor
 
         return height, width
@@ -210,19 +397,29 @@ class VaeImageProcessor(ConfigMixin):
         Resize image.
         """
         if isinstance(image, PIL.Image.Image):
-            image = image.resize((width, height), resample=PIL_INTERPOLATION[self.config.resample])
+            image = image.resize((width, height), resample=self._resample)
         elif isinstance(image, torch.Tensor):
             image = torch.nn.functional.interpolate(
                 image,
                 size=(height, width),
             )
         elif isinstance(image, np.ndarray):
-            image = self.numpy_to_pt(image)
-            image = torch.nn.functional.interpolate(
-                image,
-                size=(height, width),
-            )
-            image = self.pt_to_numpy(image)
+            if self._cv2_interpolation is not None and image.dtype in (np.float32, np.float64):
+                # OpenCV resamples with the same filter as PIL, and releases the GIL so the batch can be resized in
+                # parallel. It is opt-in, since it changes the output of the default nearest-neighbour interpolation
+                resized = _map_images(
+                    lambda i: self._cv2_resize(i, (width, height), interpolation=self._cv2_interpolation), list(image)
+                )
+                resized = np.stack(resized, axis=0).reshape((image.shape[0], height, width) + image.shape[3:])
+                # lanczos and bicubic filters overshoot, keep the values within the range of the input
+                image = np.clip(resized, image.min(), image.max(), out=resized)
+            else:
+                image = self.numpy_to_pt(image)
+                image = torch.nn.functional.interpolate(
+                    image,
+                    size=(height, width),
+                )
+                image = self.pt_to_numpy(image)
         return image
 
     def binarize(self, image: PIL.Image.Image) -> PIL.Image.Image:
@@ -238,14 +435,36 @@ class VaeImageProcessor(ConfigMixin):
         image: Union[torch.FloatTensor, PIL.Image.Image, np.ndarray],
         height: Optional[int] = None,
         width: Optional[int] = None,
+        device: Optional[Union[str, torch.device]] = None,
+        out: Optional[torch.Tensor] = None,
     ) -> torch.Tensor:
         """
         Preprocess the image input. Accepted formats are PIL images, NumPy arrays or PyTorch tensors.
+
+        Args:
+            device (`str` or `torch.device`, *optional*):
+                The device to return the preprocessed images on, whatever the input type. If it is not the CPU, 8-bit
+                PIL images are copied to it as uint8 and converted to float there, which moves a quarter of the bytes.
+                Copies to CUDA devices go through pinned memory and don't block the host.
+            out (`torch.Tensor`, *optional*):
+                A tensor to write the preprocessed images into, for example to reuse the same buffer across calls with
+                a fixed resolution. It must have the shape of the output and must not require grad. PIL images are
+                converted straight into it when it is a float32 CPU tensor in `torch.channels_last` memory format.
         """
-        supported_formats = (PIL.Image.Image, np.ndarray, torch.Tensor)
+        if out is not None and out.requires_grad:
+            raise ValueError("`out` must not require grad, the preprocessed images are written into it in place.")
+
+        # read the config once, its attribute lookups go through the FrozenDict
+        config = self.config
+        do_resize = config.do_resize
+        do_normalize = config.do_normalize
+        do_binarize = config.do_binarize
+        do_convert_rgb = config.do_convert_rgb
+        do_convert_grayscale = config.do_convert_grayscale
+        device = torch.device(device) if device is not None else None
 
         # Expand the missing dimension for 3-dimensional pytorch tensor or numpy array that represents grayscale image
-        if self.config.do_convert_grayscale and isinstance(image, (torch.Tensor, np.ndarray)) and image.ndim == 3:
+        if do_convert_grayscale and isinstance(image, (torch.Tensor, np.ndarray)) and image.ndim == 3:
             if isinstance(image, torch.Tensor):
                 # if image is a pytorch tensor could have 2 possible shapes:
                 #    1. batch x height x width: we should insert the channel dimension at position 1
@@ -262,51 +481,78 @@ class VaeImageProcessor(ConfigMixin):
                 else:
                     image = np.expand_dims(image, axis=-1)
 
-        if isinstance(image, supported_formats):
+        if isinstance(image, _SUPPORTED_FORMATS):
             image = [image]
-        elif not (isinstance(image, list) and all(isinstance(i, supported_formats) for i in image)):
+        elif not (isinstance(image, list) and all(isinstance(i, _SUPPORTED_FORMATS) for i in image)):
             raise ValueError(
-                f"Input is in incorrect format: {[type(i) for i in image]}. Currently, we only support {', '.join(supported_formats)}"
+                f"Input is in incorrect format: {[type(i) for i in image]}. Currently, we only support {', '.join(f.__name__ for f in _SUPPORTED_FORMATS)}"
             )
 
         if isinstance(image[0], PIL.Image.Image):
-            if self.config.do_convert_rgb:
-                image = [self.convert_to_rgb(i) for i in image]
-            elif self.config.do_convert_grayscale:
-                image = [self.convert_to_grayscale(i) for i in image]
-            if self.config.do_resize:
+            if do_convert_rgb:
+                image = _map_images(self.convert_to_rgb, image)
+            elif do_convert_grayscale:
+                image = _map_images(self.convert_to_grayscale, image)
+            if do_resize:
                 height, width = self.get_default_height_width(image[0], height, width)
-                image = [self.resize(i, height, width) for i in image]
-            image = self.pil_to_numpy(image)  # to np
-            image = self.numpy_to_pt(image)  # to pt
+                image = _map_images(lambda i: self.resize(i, height, width), image)
+            if device is not None and device.type != "cpu":
+                image_uint8 = _pil_to_uint8(image, pin_memory=device.type == "cuda")
+            else:
+                image_uint8 = None
+            # PIL inputs are mapped straight to the target range, so they skip the normalization below
+            if image_uint8 is not None:
+                image = _uint8_to_float32(image_uint8.to(device, non_blocking=True), normalize=do_normalize)
+            else:
+                buffer = None
+                if (
+                    out is not None
+                    and out.device.type == "cpu"
+                    and out.dtype == torch.float32
+                    and out.is_contiguous(memory_format=torch.channels_last)
+                ):
+                    # the NHWC storage of a channels-last `out` can be filled directly, without an intermediate array
+                    buffer = out.permute(0, 2, 3, 1).numpy()
+                image = _pil_to_float32(image, normalize=do_normalize, out=buffer)  # to np
+                image = self.numpy_to_pt(image)  # to pt
+            do_normalize = False
 
         elif isinstance(image[0], np.ndarray):
             image = np.concatenate(image, axis=0) if image[0].ndim == 4 else np.stack(image, axis=0)
 
+            height, width = self.get_default_height_width(image, height, width)
+            # skip the resampling (a full copy) when the size already matches
+            if do_resize and self._cv2_interpolation is not None and image.shape[1:3] != (height, width):
+                # resampled with OpenCV while still a NumPy array
+                image = self.resize(image, height, width)
+
             image = self.numpy_to_pt(image)
 
-            height, width = self.get_default_height_width(image, height, width)
-            if self.config.do_resize:
+            if do_resize and image.shape[2:] != (height, width):
                 image = self.resize(image, height, width)
 
         elif isinstance(image[0], torch.Tensor):
             image = torch.cat(image, axis=0) if image[0].ndim == 4 else torch.stack(image, axis=0)
 
-            if self.config.do_convert_grayscale and image.ndim == 3:
+            if do_convert_grayscale and image.ndim == 3:
                 image = image.unsqueeze(1)
 
             channel = image.shape[1]
             # don't need any preprocess if the image is latents
             if channel == 4:
-                return image
+                if device is not None:
+                    image = image.to(device)
+                return self._copy_to_out(image, out)
 
             height, width = self.get_default_height_width(image, height, width)
-            if self.config.do_resize:
+            # the batch is resized on its own device; skip the interpolation (a full copy) when the size already matches
+            if do_resize and image.shape[2:] != (height, width):
                 image = self.resize(image, height, width)
 
         # expected range [0,1], normalize to [-1,1]
-        do_normalize = self.config.do_normalize
-        if image.min() < 0 and do_normalize:
+        # PIL inputs are already normalized at this point, so the range check (a full reduction that synchronizes with
+        # the device) only runs for user-supplied arrays and tensors that still need normalizing
+        if do_normalize and image.min() < 0:
             warnings.warn(
                 "Passing `image` as torch tensor with value range in [-1,1] is deprecated. The expected value range for image tensor is [0,1] "
                 f"when passing as pytorch tensor or numpy Array. You passed `image` with value range [{image.min()},{image.max()}]",
@@ -315,12 +561,33 @@ class VaeImageProcessor(ConfigMixin):
             do_normalize = False
 
         if do_normalize:
-            image = self.normalize(image)
+            # `image` is always a new tensor at this point (inputs are copied by the concatenation or the resize), so
+            # it can be normalized in place without touching the caller's data
+            image = self.normalize(image, inplace=True)
 
-        if self.config.do_binarize:
+        if do_binarize:
             image = self.binarize(image)
 
-        return image
+        if device is not None:
+            image = image.to(device)
+
+        return self._copy_to_out(image, out)
+
+    @staticmethod
+    def _copy_to_out(image: torch.Tensor, out: Optional[torch.Tensor]) -> torch.Tensor:
+        """
+        Copy the preprocessed `image` into the `out` buffer passed to `preprocess`, if any.
+        """
+        if out is None:
+            return image
+        if out.shape != image.shape:
+            raise ValueError(
+                f"`out` has shape {tuple(out.shape)}, but the preprocessed image has shape {tuple(image.shape)}."
+            )
+        # PIL inputs may already have been written into `out`
+        if out.data_ptr() != image.data_ptr() or out.stride() != image.stride():
+            out.copy_(image)
+        return out
 
     def postprocess(
         self,
@@ -346,9 +613,11 @@ class VaeImageProcessor(ConfigMixin):
         if do_denormalize is None:
             do_denormalize = [self.config.do_normalize] * image.shape[0]
 
-        image = torch.stack(
-            [self.denormalize(image[i]) if do_denormalize[i] else image[i] for i in range(image.shape[0])]
-        )
+        if output_type == "pil":
+            # denormalize and quantize in a single buffer on device, so that only uint8 data is copied to host
+            return self.numpy_to_pil(_pt_to_uint8_numpy(image, do_denormalize))
+
+        image = self._denormalize_conditionally(image, do_denormalize)
 
         if output_type == "pt":
             return image
@@ -358,9 +627,6 @@ class VaeImageProcessor(ConfigMixin):
         if output_type == "np":
             return image
 
-        if output_type == "pil":
-            return self.numpy_to_pil(image)
-
 
 class VaeImageProcessorLDM3D(VaeImageProcessor):
     """
@@ -387,21 +653,27 @@ class VaeImageProcessorLDM3D(VaeImageProcessor):
         resample: str = "lanczos",
         do_normalize: bool = True,
     ):
-        super().__init__()
+        super().__init__(
+            do_resize=do_resize, vae_scale_factor=vae_scale_factor, resample=resample, do_normalize=do_normalize
+        )
 
     @staticmethod
     def numpy_to_pil(images):
         """
-        Convert a NumPy image or a batch of images to a PIL image.
+        Convert a NumPy image or a batch of images to a PIL image. Float images are expected in [0,1], uint8 images are
+        used as is.
         """
         if images.ndim == 3:
             images = images[None, ...]
-        images = (images * 255).round().astype("uint8")
+        if images.dtype != np.uint8:
+            images = (images * 255).round().astype("uint8")
         if images.shape[-1] == 1:
             # special case for grayscale (single channel) images
             pil_images = [Image.fromarray(image.squeeze(), mode="L") for image in images]
         else:
-            pil_images = [Image.fromarray(image[:, :, :3]) for image in images]
+            # slice the RGB channels of the whole batch into one contiguous array rather than copying them per image
+            images = np.ascontiguousarray(images[:, :, :, :3])
+            pil_images = [Image.fromarray(image) for image in images]
 
         return pil_images
 
@@ -409,12 +681,15 @@ class VaeImageProcessorLDM3D(VaeImageProcessor):
     def rgblike_to_depthmap(image):
         """
         Args:
-            image: RGB-like depth image
+            image: RGB-like depth image, or a batch of them
 
         Returns: depth map
 
         """
-        return image[:, :, 1] * 2**8 + image[:, :, 2]
+        if image.dtype == np.uint8:
+            # the high and low bytes are adjacent in memory, so read them as a single big-endian uint16
+            return np.ascontiguousarray(image[..., 1:3]).view(">u2")[..., 0].astype(np.uint16)
+        return image[..., 1] * 2**8 + image[..., 2]
 
     def numpy_to_depth(self, images):
         """
@@ -424,12 +699,16 @@ class VaeImageProcessorLDM3D(VaeImageProcessor):
             images = images[None, ...]
         images_depth = images[:, :, :, 3:]
         if images.shape[-1] == 6:
-            images_depth = (images_depth * 255).round().astype("uint8")
-            pil_images = [
-                Image.fromarray(self.rgblike_to_depthmap(image_depth), mode="I;16") for image_depth in images_depth
-            ]
+            if images_depth.dtype != np.uint8:
+                images_depth = (images_depth * 255).round().astype("uint8")
+            images_depth = self.rgblike_to_depthmap(images_depth)
+            pil_images = [Image.fromarray(image_depth, mode="I;16") for image_depth in images_depth]
         elif images.shape[-1] == 4:
-            images_depth = (images_depth * 65535.0).astype(np.uint16)
+            # scale and truncate straight into the uint16 output, dropping the single channel dimension so that PIL
+            # receives the 2D arrays it expects for mode "I;16"
+            images_depth = np.multiply(
+                images[:, :, :, 3], 65535.0, out=np.empty(images.shape[:3], dtype=np.uint16), casting="unsafe"
+            )
             pil_images = [Image.fromarray(image_depth, mode="I;16") for image_depth in images_depth]
         else:
             raise Exception("Not supported")
@@ -457,15 +736,18 @@ class VaeImageProcessorLDM3D(VaeImageProcessor):
         if do_denormalize is None:
             do_denormalize = [self.config.do_normalize] * image.shape[0]
 
-        image = torch.stack(
-            [self.denormalize(image[i]) if do_denormalize[i] else image[i] for i in range(image.shape[0])]
-        )
+        if output_type == "pil" and image.shape[1] == 6:
+            # the RGB-like depth channels are 8-bit as well, so quantize everything before leaving the device
+            image = _pt_to_uint8_numpy(image, do_denormalize)
+            return self.numpy_to_pil(image), self.numpy_to_depth(image)
+
+        image = self._denormalize_conditionally(image, do_denormalize)
 
         image = self.pt_to_numpy(image)
 
         if output_type == "np":
             if image.shape[-1] == 6:
-                image_depth = np.stack([self.rgblike_to_depthmap(im[:, :, 3:]) for im in image], axis=0)
+                image_depth = self.rgblike_to_depthmap(image[:, :, :, 3:])
             else:
                 image_depth = image[:, :, :, 3:]
             return image[:, :, :, :3], image_depth
@@ -70,6 +70,7 @@ from .import_utils import (
     is_note_seq_available,
     is_omegaconf_available,
     is_onnx_available,
+    is_opencv_available,
     is_peft_available,
     is_scipy_available,
     is_tensorboard_available,
@@ -13,13 +13,25 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import os
+import signal
+import subprocess
+import sys
 import unittest
+from unittest import mock
 
 import numpy as np
 import PIL.Image
 import torch
 
-from diffusers.image_processor import VaeImageProcessor
+from diffusers.image_processor import (
+    VaeImageProcessor,
+    VaeImageProcessorLDM3D,
+    _pil_to_uint8,
+    _uint8_to_float32,
+)
+from diffusers.utils import is_opencv_available
+from diffusers.utils.testing_utils import require_torch_gpu
 
 
 class ImageProcessorTest(unittest.TestCase):
@@ -308,3 +320,234 @@ class ImageProcessorTest(unittest.TestCase):
         assert (
             out_np.shape == exp_np_shape
         ), f"resized image output shape '{out_np.shape}' didn't match expected shape '{exp_np_shape}'."
+
+    def test_vae_image_processor_postprocess_mixed_denormalize(self):
+        image_processor = VaeImageProcessor(do_resize=False, do_normalize=True)
+
+        input_pt = torch.cat([self.dummy_sample] * 3, axis=0) * 2 - 1
+        do_denormalize = [True, False, True]
+
+        out_pt = image_processor.postprocess(input_pt, output_type="pt", do_denormalize=do_denormalize)
+        exp_pt = torch.stack(
+            [(input_pt[i] / 2 + 0.5).clamp(0, 1) if do_denormalize[i] else input_pt[i] for i in range(3)]
+        )
+        assert (out_pt - exp_pt).abs().max() < 1e-6
+
+    def test_vae_image_processor_ldm3d_rgblike_to_depthmap(self):
+        image = np.random.randint(0, 256, size=(2, 8, 8, 3), dtype=np.uint8)
+
+        depth = VaeImageProcessorLDM3D.rgblike_to_depthmap(image)
+        exp_depth = image[..., 1].astype(np.uint16) * 2**8 + image[..., 2]
+
+        assert depth.dtype == np.uint16
+        assert np.array_equal(depth, exp_depth)
+
+    def test_preprocess_does_not_modify_input(self):
+        image_processor = VaeImageProcessor(do_resize=False, do_normalize=True)
+
+        input_pt = self.dummy_sample
+        input_np = self.to_np(input_pt)
+        exp_pt = input_pt.clone()
+        exp_np = input_np.copy()
+
+        image_processor.preprocess(input_pt)
+        image_processor.preprocess(input_np)
+
+        assert torch.equal(input_pt, exp_pt)
+        assert np.array_equal(input_np, exp_np)
+
+    def test_vae_image_processor_ldm3d_postprocess_pil(self):
+        image_processor = VaeImageProcessorLDM3D(do_normalize=False)
+
+        for num_channels in [4, 6]:
+            input_pt = torch.rand((2, num_channels, 8, 8))
+            out_rgb, out_depth = image_processor.postprocess(input_pt, output_type="pil")
+
+            assert len(out_rgb) == len(out_depth) == 2
+            assert all(image.mode == "RGB" and image.size == (8, 8) for image in out_rgb)
+            assert all(image.mode == "I;16" and image.size == (8, 8) for image in out_depth)
+
+    def test_preprocess_out(self):
+        image_processor = VaeImageProcessor(do_resize=False, do_normalize=True)
+
+        input_np = self.dummy_sample.cpu().numpy().transpose(0, 2, 3, 1)
+        input_pil = image_processor.numpy_to_pil(input_np)
+        exp_pt = image_processor.preprocess(input_pil)
+
+        for memory_format in [torch.channels_last, torch.contiguous_format]:
+            out = torch.empty(exp_pt.shape).to(memory_format=memory_format)
+            out_pt = image_processor.preprocess(input_pil, out=out)
+
+            assert out_pt is out
+            assert torch.equal(out_pt, exp_pt)
+
+    def test_preprocess_out_shape_mismatch(self):
+        image_processor = VaeImageProcessor(do_resize=False, do_normalize=True)
+
+        input_np = self.dummy_sample.cpu().numpy().transpose(0, 2, 3, 1)
+        input_pil = image_processor.numpy_to_pil(input_np)
+
+        # same number of elements as the output, but a different shape
+        out = torch.full((1, 3, 16, 4), 5.0).to(memory_format=torch.channels_last)
+        with self.assertRaises(ValueError):
+            image_processor.preprocess(input_pil, out=out)
+        assert torch.all(out == 5.0), "`out` was written to before its shape was checked"
+
+    def test_preprocess_out_requires_grad(self):
+        image_processor = VaeImageProcessor(do_resize=False, do_normalize=True)
+
+        input_np = self.dummy_sample.cpu().numpy().transpose(0, 2, 3, 1)
+        input_pil = image_processor.numpy_to_pil(input_np)
+
+        for memory_format in [torch.channels_last, torch.contiguous_format]:
+            out = torch.empty((1, 3, 8, 8), memory_format=memory_format, requires_grad=True)
+            assert out.is_leaf
+            with self.assertRaises(ValueError):
+                image_processor.preprocess(input_pil, out=out)
+
+    def test_postprocess_does_not_alias_input(self):
+        image_processor = VaeImageProcessor(do_resize=False, do_normalize=True)
+
+        input_pt = self.dummy_sample
+        exp_pt = input_pt.clone()
+
+        out_pt = image_processor.postprocess(input_pt, output_type="pt", do_denormalize=[False])
+        out_np = image_processor.postprocess(input_pt, output_type="np", do_denormalize=[False])
+        out_pt.zero_()
+        out_np.fill(0)
+
+        assert torch.equal(input_pt, exp_pt)
+
+    @unittest.skipIf(not hasattr(os, "fork"), "requires os.fork")
+    def test_preprocess_pil_batch_after_fork(self):
+        image_processor = VaeImageProcessor(do_resize=True, vae_scale_factor=8)
+
+        input_np = torch.rand((4, 37, 45, 3)).numpy()
+        input_pil = image_processor.numpy_to_pil(input_np)
+
+        # use the thread pool in the parent before forking
+        image_processor.preprocess(input_pil)
+
+        pid = os.fork()
+        if pid == 0:
+            # the child must not hang on the pool of the parent
+            signal.alarm(10)
+            try:
+                out = image_processor.preprocess(input_pil)
+                os._exit(0 if tuple(out.shape) == (4, 3, 32, 40) else 1)
+            except BaseException:
+                os._exit(1)
+
+        _, status = os.waitpid(pid, 0)
+        assert os.WIFEXITED(status) and os.WEXITSTATUS(status) == 0, f"child process failed with status {status}"
+
+    def test_preprocess_normalize_integer_input(self):
+        image_processor = VaeImageProcessor(do_resize=False, do_normalize=True)
+
+        input_np = (np.arange(2 * 8 * 8 * 3) % 256).astype(np.uint8).reshape(2, 8, 8, 3)
+        expected = 2.0 * torch.from_numpy(input_np).permute(0, 3, 1, 2).float() - 1.0
+
+        for input in [input_np, torch.from_numpy(input_np).permute(0, 3, 1, 2).contiguous()]:
+            out = image_processor.preprocess(input)
+            assert out.dtype == torch.float32, f"unexpected dtype {out.dtype} for {type(input)} input"
+            assert torch.equal(out, expected), f"wrong normalization for {type(input)} input"
+
+    def test_preprocess_device(self):
+        image_processor = VaeImageProcessor(do_resize=False, do_normalize=True)
+
+        input_np = torch.rand((1, 8, 8, 3)).numpy()
+        inputs = {
+            "pil_8bit": image_processor.numpy_to_pil(input_np),
+            "pil_16bit": PIL.Image.fromarray((input_np[0, :, :, 0] * 65535).astype(np.uint16)),
+            "np": input_np,
+            "pt": torch.from_numpy(input_np).permute(0, 3, 1, 2),
+            "latents": torch.rand((1, 4, 8, 8)),
+        }
+        for name, input in inputs.items():
+            out = image_processor.preprocess(input, device="meta")
+            assert out.device.type == "meta", f"{name} input was returned on {out.device}"
+
+    def test_preprocess_pil_uint8_conversion(self):
+        # every uint8 value, as two 8x16 RGB images
+        input_np = np.arange(256 * 3, dtype=np.int64).reshape(2, 8, 16, 3) % 256
+        input_pil = [PIL.Image.fromarray(i.astype(np.uint8)) for i in input_np]
+
+        for do_normalize in [True, False]:
+            image_processor = VaeImageProcessor(do_resize=False, do_normalize=do_normalize)
+            exp_pt = image_processor.preprocess(input_pil)
+
+            # the conversion used for non-CPU devices must match the lookup tables of the CPU path exactly
+            out_pt = _uint8_to_float32(_pil_to_uint8(input_pil), normalize=do_normalize)
+            assert torch.equal(out_pt, exp_pt), f"mismatch with do_normalize={do_normalize}"
+
+    @require_torch_gpu
+    def test_preprocess_pil_uint8_conversion_cuda(self):
+        input_np = np.arange(256 * 3, dtype=np.int64).reshape(2, 8, 16, 3) % 256
+        input_pil = [PIL.Image.fromarray(i.astype(np.uint8)) for i in input_np]
+
+        for do_normalize in [True, False]:
+            image_processor = VaeImageProcessor(do_resize=False, do_normalize=do_normalize)
+            exp_pt = image_processor.preprocess(input_pil)
+
+            out_pt = image_processor.preprocess(input_pil, device="cuda")
+            assert out_pt.device.type == "cuda"
+            assert torch.equal(out_pt.cpu(), exp_pt), f"mismatch with do_normalize={do_normalize}"
+
+    def test_preprocess_target_size_does_not_modify_input(self):
+        image_processor = VaeImageProcessor(do_resize=True, vae_scale_factor=8, do_normalize=True)
+
+        # already at the target size, so the resize is skipped and the input must not be normalized in place
+        input_np = torch.rand((2, 16, 16, 3)).numpy()
+        input_pt = torch.rand((2, 3, 16, 16))
+        input_np_copy = input_np.copy()
+        input_pt_copy = input_pt.clone()
+
+        out_np = image_processor.preprocess(input_np)
+        out_pt = image_processor.preprocess(input_pt)
+
+        assert out_np.shape == out_pt.shape == (2, 3, 16, 16)
+        assert np.array_equal(input_np, input_np_copy), "preprocess modified the numpy input"
+        assert torch.equal(input_pt, input_pt_copy), "preprocess modified the pytorch input"
+
+    def test_resize_np_defaults_to_nearest(self):
+        image_processor = VaeImageProcessor(do_resize=True, vae_scale_factor=8)
+
+        input_np = torch.rand((2, 37, 45, 3)).numpy()
+        expected = torch.nn.functional.interpolate(torch.from_numpy(input_np).permute(0, 3, 1, 2), size=(32, 40))
+
+        out = image_processor.resize(input_np, 32, 40)
+        assert np.array_equal(out, expected.permute(0, 2, 3, 1).numpy())
+
+    @unittest.skipIf(not is_opencv_available(), "requires OpenCV")
+    def test_resize_np_opencv(self):
+        import cv2
+
+        image_processor = VaeImageProcessor(do_resize=True, vae_scale_factor=8, use_opencv_resize=True)
+
+        input_np = torch.rand((2, 37, 45, 3)).numpy()
+        expected = np.stack([cv2.resize(i, (40, 32), interpolation=cv2.INTER_LANCZOS4) for i in input_np])
+        expected = np.clip(expected, input_np.min(), input_np.max())
+
+        out = image_processor.resize(input_np, 32, 40)
+        assert np.allclose(out, expected)
+
+    def test_import_without_importable_opencv(self):
+        # opencv-python can be installed but fail to import, e.g. without libGL in headless containers
+        code = (
+            "import sys; sys.modules['cv2'] = None; "
+            "from diffusers.image_processor import VaeImageProcessor; VaeImageProcessor()"
+        )
+        result = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True)
+        assert result.returncode == 0, result.stderr
+
+    def test_opencv_resize_requires_opencv(self):
+        with mock.patch("diffusers.image_processor.is_opencv_available", return_value=False):
+            with self.assertRaises(ImportError):
+                VaeImageProcessor(use_opencv_resize=True)
+
+    def test_preprocess_unsupported_input(self):
+        image_processor = VaeImageProcessor()
+
+        with self.assertRaises(ValueError) as error:
+            image_processor.preprocess(["not an image"])
+        assert "Image, ndarray, Tensor" in str(error.exception)